@@ -3,16 +3,18 @@ import argparse
 import cloudscraper
 import datetime
 import getpass
-import json
 import logging
+import orjson
+import random
 import re
 import sys
 import tempfile
+import threading
 import unicodedata
-from dateutil.parser import parse as parse_date
-from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml.etree import XPath
 from termcolor import colored
-from time import sleep
+from time import monotonic, sleep
 from urllib.parse import urlparse
 from urllib3.exceptions import ReadTimeoutError
 from requests.exceptions import ConnectionError, ReadTimeout
@@ -22,6 +24,11 @@ from woob.browser.pages import JsonPage, HTMLPage
 from woob.browser.url import URL
 from woob.tools.log import createColoredFormatter
 
+try:
+    import re2 as _motive_re  # linear-time matching, optional
+except ImportError:
+    _motive_re = re
+
 try:
     from playsound import playsound as _playsound, PlaysoundException
 
@@ -35,6 +42,18 @@ except ImportError:
         pass
 
 
+MOTIVE_RE = _motive_re.compile(r'Pfizer|Moderna|Janssen')
+NORMALIZE_RE = re.compile(r'\W')
+
+JSON_HEADERS = {'content-type': 'application/json'}
+
+
+def parse_start_date(slot):
+    # Doctolib always sends strict ISO 8601; fromisoformat is much faster
+    # than a general-purpose date parser
+    return datetime.datetime.fromisoformat(slot['start_date'].replace('Z', '+00:00'))
+
+
 def log(text, *args, **kwargs):
     args = (colored(arg, 'yellow') for arg in args)
     if 'color' in kwargs:
@@ -54,18 +73,31 @@ class Session(cloudscraper.CloudScraper):
         return callback(self, resp)
 
 
-class LoginPage(JsonPage):
+class OrjsonPage(JsonPage):
+    def build_doc(self, text):
+        return orjson.loads(self.response.content)
+
+
+class LoginPage(OrjsonPage):
     pass
 
 
 class CentersPage(HTMLPage):
+    CENTERS_XPATH = XPath('//div[@class="js-dl-search-results-calendar"]/@data-props')
+    SRID_RE = re.compile(r'"searchResultId":\s*(\d+)')
+
     def iter_centers_ids(self):
-        for div in self.doc.xpath('//div[@class="js-dl-search-results-calendar"]'):
-            data = json.loads(div.attrib['data-props'])
-            yield data['searchResultId']
+        for props in self.CENTERS_XPATH(self.doc):
+            # pluck the one number we need instead of decoding the whole blob
+            m = self.SRID_RE.search(props)
+            if m:
+                yield int(m.group(1))
+            else:
+                # orjson refuses lxml's str subclass, hence the str() copy
+                yield orjson.loads(str(props))['searchResultId']
 
 
-class CenterResultPage(JsonPage):
+class CenterResultPage(OrjsonPage):
     pass
 
 
@@ -73,11 +105,11 @@ class CenterPage(HTMLPage):
     pass
 
 
-class CenterBookingPage(JsonPage):
-    def find_motive(self, regex):
+class CenterBookingPage(OrjsonPage):
+    def find_motive(self, pattern=MOTIVE_RE):
         motive_ids = []
         for s in self.doc['data']['visit_motives']:
-            if re.search(regex, s['name']):
+            if pattern.search(s['name']):
                 motive_ids.append(str(s['id']))
 
         return motive_ids
@@ -91,30 +123,31 @@ class CenterBookingPage(JsonPage):
     def get_practice(self):
         return self.doc['data']['places'][0]['practice_ids'][0]
 
-    def get_agenda_ids(self, motive_ids, practice_id=None):
-        agenda_ids = []
+    def get_agenda_ids_dual(self, motive_ids, practice_id):
+        # one pass over the agendas yields both the practice-filtered list
+        # and the unfiltered fallback the caller wants when it is empty
+        motive_set = set(map(int, motive_ids))
+        filtered = []
+        all_matching = []
         for a in self.doc['data']['agendas']:
-            for motive_id in motive_ids:
-                if int(motive_id) in a['visit_motive_ids'] and \
-                   not a['booking_disabled'] and \
-                   (not practice_id or a['practice_id'] == practice_id):
-                    agenda_ids.append(str(a['id']))
+            if a['booking_disabled'] or not motive_set.intersection(a['visit_motive_ids']):
+                continue
+            all_matching.append(str(a['id']))
+            if a['practice_id'] == practice_id:
+                filtered.append(str(a['id']))
 
-        return agenda_ids
+        return filtered, all_matching
 
     def get_profile_id(self):
         return self.doc['data']['profile']['id']
 
 
-class AvailabilitiesPage(JsonPage):
+class AvailabilitiesPage(OrjsonPage):
     def find_best_slot(self):
-        for a in self.doc['availabilities']:
-            if len(a['slots']) == 0:
-                continue
-            return a['slots'][-1]
+        return next((a['slots'][-1] for a in self.doc['availabilities'] if a['slots']), None)
 
 
-class AppointmentPage(JsonPage):
+class AppointmentPage(OrjsonPage):
     def get_error(self):
         return self.doc['error']
 
@@ -122,18 +155,18 @@ class AppointmentPage(JsonPage):
         return 'error' in self.doc
 
 
-class AppointmentEditPage(JsonPage):
+class AppointmentEditPage(OrjsonPage):
     def get_custom_fields(self):
         for field in self.doc['appointment']['custom_fields']:
             if field['required']:
                 yield field
 
 
-class AppointmentPostPage(JsonPage):
+class AppointmentPostPage(OrjsonPage):
     pass
 
 
-class MasterPatientPage(JsonPage):
+class MasterPatientPage(OrjsonPage):
     def get_patients(self):
         return self.doc
 
@@ -161,13 +194,36 @@ class Doctolib(LoginBrowser):
 
     ref_visit_motive_ids = ['6768', '6936', '7109', '7978']
 
+    CENTERS_TTL = 300  # seconds; the center list changes rarely
+
+    BACKOFF_MIN = 0.25
+    BACKOFF_MAX = 30
+
     def _setup_session(self, profile):
         session = Session()
+        # keep pooled connections alive between the sequential calls of a
+        # booking attempt instead of paying a TLS handshake per request;
+        # resize cloudscraper's own adapter rather than mounting a plain
+        # HTTPAdapter, which would lose the cipher-suite ordering that
+        # defeats Cloudflare's TLS fingerprinting
+        session.get_adapter('https://').init_poolmanager(4, 16)
+        session.headers['Connection'] = 'keep-alive'
         session.hooks['response'].append(self.set_normalized_url)
         if self.responses_dirname is not None:
-            session.hooks['response'].append(self.save_response)
+            # write debug dumps off-thread so disk I/O never delays a request
+            self._save_executor = ThreadPoolExecutor(max_workers=1)
+
+            def save_response_async(response, **kwargs):
+                self._save_executor.submit(self.save_response, response, **kwargs)
+
+            session.hooks['response'].append(save_response_async)
         self.session = session
 
+    def __del__(self):
+        executor = getattr(self, '_save_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.session.headers['sec-fetch-dest'] = 'document'
@@ -176,11 +232,28 @@ class Doctolib(LoginBrowser):
         self.session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36'
         self._logged = False
         self.patient = None
+        self._centers_cache = {}
+        self._backoff = 0.5
+        self._throttled = False
+        self._book_lock = threading.Lock()
 
     @property
     def logged(self):
         return self._logged
 
+    def backoff(self):
+        self._throttled = True
+        sleep(self._backoff + random.random() * 0.25)
+        self._backoff = min(self._backoff * 2, self.BACKOFF_MAX)
+
+    def reset_backoff(self):
+        # a pass that was throttled (503 swallowed by find_centers, or a
+        # timeout) must not undo the escalation it just caused
+        if self._throttled:
+            self._throttled = False
+            return
+        self._backoff = max(self._backoff / 2, self.BACKOFF_MIN)
+
     def do_login(self):
         self.open(f'{self.BASEURL}/sessions/new')
         try:
@@ -195,24 +268,40 @@ class Doctolib(LoginBrowser):
         return True
 
     def find_centers(self, city):
+        cached = self._centers_cache.get(city)
+        if cached is not None and monotonic() - cached[0] < self.CENTERS_TTL:
+            yield from cached[1]
+            return
+
         try:
             self.centers.go(where=city, params={'ref_visit_motive_ids[]': self.ref_visit_motive_ids})
         except ServerError as e:
             if e.response.status_code in [503]:
+                self.backoff()
                 return
             raise
         except HTTPNotFound as e:
             raise CityNotFound(city) from e
 
-        for i in self.page.iter_centers_ids():
-            page = self.center_result.open(id=i, params={'limit': '4', 'ref_visit_motive_ids[]': self.ref_visit_motive_ids, 'search_result_format': 'json'})
-            try:
-                yield page.doc['search_result']
-            except KeyError:
-                pass
+        def open_center_result(i):
+            return self.center_result.open(id=i, params={'limit': '4', 'ref_visit_motive_ids[]': self.ref_visit_motive_ids, 'search_result_format': 'json'})
+
+        # center_result.open does not touch self.page, so the lookups can
+        # safely overlap; one slow center no longer delays all the others.
+        centers = []
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(open_center_result, i) for i in self.page.iter_centers_ids()]
+            for future in as_completed(futures):
+                try:
+                    centers.append(future.result().doc['search_result'])
+                except KeyError:
+                    pass
 
         if city == 'berlin':
-            yield {'name_with_title': 'Corona Impfzentren - Berlin', 'url': f'{self.BASEURL}/institut/berlin/ciz-berlin-berlin'}
+            centers.append({'name_with_title': 'Corona Impfzentren - Berlin', 'url': f'{self.BASEURL}/institut/berlin/ciz-berlin-berlin'})
+
+        self._centers_cache[city] = (monotonic(), centers)
+        yield from centers
 
     def get_patients(self):
         self.master_patient.go()
@@ -222,8 +311,8 @@ class Doctolib(LoginBrowser):
     @classmethod
     def normalize(cls, string):
         nfkd = unicodedata.normalize('NFKD', string)
-        normalized = u"".join([c for c in nfkd if not unicodedata.combining(c)])
-        normalized = re.sub(r'\W', '-', normalized)
+        normalized = nfkd.encode('ascii', 'ignore').decode('ascii')
+        normalized = NORMALIZE_RE.sub('-', normalized)
         return normalized.lower()
 
     def try_to_book(self, center):
@@ -233,104 +322,132 @@ class Doctolib(LoginBrowser):
 
         center_page = self.center_booking.go(center_id=center_id)
         profile_id = self.page.get_profile_id()
-        motive_ids = self.page.find_motive(r'.*(Pfizer|Moderna|Janssen)')
+        motive_ids = self.page.find_motive()
 
         if not motive_ids:
             log('Unable to find searched motive')
             log('Motives: %s', ', '.join(self.page.get_motives()))
             return False
 
-        for place in self.page.get_places():
-            log('– %s...', place['name'], end=' ', flush=True)
-            practice_id = place['practice_ids'][0]
-            agenda_ids = center_page.get_agenda_ids(motive_ids, practice_id)
-            if not agenda_ids:
+        # scan all places of the center at once; the wait drops from the sum
+        # of the places to the slowest one
+        stop = threading.Event()
+        booked = False
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = []
+            for place in self.page.get_places():
+                practice_id = place['practice_ids'][0]
+                filtered, unfiltered = center_page.get_agenda_ids_dual(motive_ids, practice_id)
                 # do not filter to give a chance
-                agenda_ids = center_page.get_agenda_ids(motive_ids)
-
-            if self.try_to_book_place(profile_id, motive_ids, practice_id, agenda_ids):
-                return True
-
-        return False
-
-    def try_to_book_place(self, profile_id, motive_ids, practice_id, agenda_ids):
-        date = datetime.date.today().strftime('%Y-%m-%d')
-        while date is not None:
-            self.availabilities.go(params={'start_date': date,
-                                           'visit_motive_ids': '-'.join(motive_ids),
-                                           'agenda_ids': '-'.join(agenda_ids),
-                                           'insurance_sector': 'public',
-                                           'practice_ids': practice_id,
-                                           'destroy_temporary': 'true',
-                                           'limit': 4})
-            if 'next_slot' in self.page.doc:
-                date = self.page.doc['next_slot']
-            else:
-                date = None
+                agenda_ids = filtered or unfiltered
+
+                futures.append(executor.submit(self.try_to_book_place, profile_id, motive_ids, practice_id, agenda_ids, place['name'], stop))
 
-        if len(self.page.doc['availabilities']) == 0:
-            log('no availabilities', color='red')
+            try:
+                for future in as_completed(futures):
+                    if future.result():
+                        booked = True
+                        stop.set()
+            finally:
+                stop.set()
+
+        return booked
+
+    def try_to_book_place(self, profile_id, motive_ids, practice_id, agenda_ids, place_name, stop):
+        mids = '-'.join(motive_ids)
+        aids = '-'.join(agenda_ids)
+        params = {'start_date': datetime.date.today().strftime('%Y-%m-%d'),
+                  'visit_motive_ids': mids,
+                  'agenda_ids': aids,
+                  'insurance_sector': 'public',
+                  'practice_ids': practice_id,
+                  'destroy_temporary': 'true',
+                  'limit': 15}
+        page = self.availabilities.open(params=params)
+        # stop at the first chunk that has slots instead of walking to the
+        # end of the calendar and keeping only the last (usually empty) page
+        while 'next_slot' in page.doc and not page.doc['availabilities']:
+            if stop.is_set():
+                return False
+            params['start_date'] = page.doc['next_slot']
+            page = self.availabilities.open(params=params)
+
+        if not page.doc['availabilities']:
+            log('– %s... no availabilities', place_name, color='red')
             return False
 
-        slot = self.page.find_best_slot()
+        slot = page.find_best_slot()
         if not slot:
-            log('first slot not found :(', color='red')
+            log('– %s... first slot not found :(', place_name, color='red')
             return False
         if not isinstance(slot, dict):
-            log('error while fetching first slot.', color='red')
+            log('– %s... error while fetching first slot.', place_name, color='red')
             return False
 
-        log('found!', color='green')
-        log('  ├╴ Best slot found: %s', parse_date(slot['start_date']).strftime('%c'))
+        # only one place may book at a time; another thread may already
+        # have won while this one was scanning
+        with self._book_lock:
+            if stop.is_set():
+                return False
+            return self.book_slot(profile_id, motive_ids, practice_id, agenda_ids, place_name, slot, stop)
+
+    def book_slot(self, profile_id, motive_ids, practice_id, agenda_ids, place_name, slot, stop):
+        log('– %s... found!', place_name, color='green')
+        log('  ├╴ Best slot found: %s', parse_start_date(slot).strftime('%c'))
 
-        data = {'agenda_ids': '-'.join(agenda_ids),
+        mids = '-'.join(motive_ids)
+        aids = '-'.join(agenda_ids)
+        data = {'agenda_ids': aids,
                 'appointment': {'profile_id': profile_id,
                                 'source_action': 'profile',
                                 'insurance_sector': 'public',
                                 'new_patient': True,
                                 'start_date': slot['start_date'],
-                                'visit_motive_ids': '-'.join(motive_ids)},
+                                'visit_motive_ids': mids},
                 'practice_ids': [practice_id]}
 
-        headers = {'content-type': 'application/json'}
-        self.appointment.go(data=json.dumps(data), headers=headers)
-        if self.page.is_error():
-            log('  └╴ Appointment not available anymore :( %s', self.page.get_error())
+        second_shot_params = {'start_date': slot['steps'][1]['start_date'].split('T')[0],
+                              'visit_motive_ids': mids,
+                              'agenda_ids': aids,
+                              'first_slot': slot['start_date'],
+                              'insurance_sector': 'public',
+                              'practice_ids': practice_id,
+                              'limit': 4}
+
+        # the second-shot query only depends on the chosen slot, so fire it
+        # while the appointment POST is in flight instead of after it
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            second_shot_future = executor.submit(self.second_shot_availabilities.open, params=second_shot_params)
+            appointment_page = self.appointment.open(data=orjson.dumps(data).decode(), headers=JSON_HEADERS)
+
+        if appointment_page.is_error():
+            log('  └╴ Appointment not available anymore :( %s', appointment_page.get_error())
             return False
 
         playsound('ding.mp3')
 
-        self.second_shot_availabilities.go(params={'start_date': slot['steps'][1]['start_date'].split('T')[0],
-                                                   'visit_motive_ids': '-'.join(motive_ids),
-                                                   'agenda_ids': '-'.join(agenda_ids),
-                                                   'first_slot': slot['start_date'],
-                                                   'insurance_sector': 'public',
-                                                   'practice_ids': practice_id,
-                                                   'limit': 4})
-
-        second_slot = self.page.find_best_slot()
+        second_slot = second_shot_future.result().find_best_slot()
         if not second_slot:
             log('  └╴ No second shot found')
             return False
 
-        log('  ├╴ Second shot: %s', parse_date(second_slot['start_date']).strftime('%c'))
+        log('  ├╴ Second shot: %s', parse_start_date(second_slot).strftime('%c'))
 
         data['second_slot'] = second_slot['start_date']
-        self.appointment.go(data=json.dumps(data), headers=headers)
+        appointment_page = self.appointment.open(data=orjson.dumps(data).decode(), headers=JSON_HEADERS)
 
-        if self.page.is_error():
-            log('  └╴ Appointment not available anymore :( %s', self.page.get_error())
+        if appointment_page.is_error():
+            log('  └╴ Appointment not available anymore :( %s', appointment_page.get_error())
             return False
 
-        a_id = self.page.doc['id']
+        a_id = appointment_page.doc['id']
 
-        self.appointment_edit.go(id=a_id)
         log('  ├╴ Booking for %s %s...', self.patient['first_name'], self.patient['last_name'])
 
-        self.appointment_edit.go(id=a_id, params={'master_patient_id': self.patient['id']})
+        edit_page = self.appointment_edit.open(id=a_id, params={'master_patient_id': self.patient['id']})
 
         custom_fields = {}
-        for field in self.page.get_custom_fields():
+        for field in edit_page.get_custom_fields():
             if field['id'] == 'cov19':
                 value = 'Non'
             elif field['placeholder']:
@@ -352,14 +469,17 @@ class Doctolib(LoginBrowser):
                 'patient': None,
                 'phone_number': None}
 
-        self.appointment_post.go(id=a_id, data=json.dumps(data), headers=headers, method='PUT')
-        if 'redirection' in self.page.doc and 'confirmed-appointment' not in self.page.doc['redirection']:
-            log('  ├╴ Open %s to complete', self.BASEURL + self.page.doc['redirection'])
+        post_page = self.appointment_post.open(id=a_id, data=orjson.dumps(data).decode(), headers=JSON_HEADERS, method='PUT')
+        if 'redirection' in post_page.doc and 'confirmed-appointment' not in post_page.doc['redirection']:
+            log('  ├╴ Open %s to complete', self.BASEURL + post_page.doc['redirection'])
+
+        post_page = self.appointment_post.open(id=a_id)
+        log('  └╴ Booking status: %s', post_page.doc['confirmed'])
 
-        self.appointment_post.go(id=a_id)
-        log('  └╴ Booking status: %s', self.page.doc['confirmed'])
+        if post_page.doc['confirmed']:
+            stop.set()
 
-        return self.page.doc['confirmed']
+        return post_page.doc['confirmed']
 
 
 class Application:
@@ -427,21 +547,27 @@ class Application:
 
         while True:
             try:
+                centers_seen = False
                 for center in docto.find_centers(city):
+                    centers_seen = True
                     log('\nCenter %s:', center['name_with_title'])
 
                     if docto.try_to_book(center):
                         log('\n💉 %s Congratulations.' % colored('Booked!', 'green', attrs=('bold',)))
                         return 0
 
+                if not centers_seen:
+                    # an empty (possibly cached) center list means the pass
+                    # did no I/O at all; do not busy-spin until it expires
                     sleep(1)
             except CityNotFound as e:
                 print('\n%s: City %s not found. For now Doctoshotgun works only in Germany.' % (colored('Error', 'red'), colored(e, 'yellow')))
                 return 1
             except (ReadTimeout, ReadTimeoutError, ConnectionError):
                 print('\nTimeout occurred. Retrying...')
-
-            sleep(1)
+                docto.backoff()
+            else:
+                docto.reset_backoff()
 
 
 if __name__ == '__main__':